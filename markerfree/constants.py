@@ -43,6 +43,7 @@ TSALIGN_PROGRAM = 'Markerfree'
 OUTPUT_TILTSERIES_NAME = "TiltSeries"
 OUTPUT_ALI_TILTSERIES_NAME = "AlignedTiltSeries"
 OUTPUT_TS_FAILED_NAME = "FailedTiltSeries"
+OUTPUT_TOMOGRAMS_NAME = "Tomograms"
 
 MRCS_EXT = 'mrcs'
 MRC_EXT = 'mrc'
@@ -52,3 +53,9 @@ TXT_EXT = 'txt'
 
 NONE_PROCESSED_MSG = 'Unable to process any of the introduced'
 NO_TS_PROCESSED_MSG = f'{NONE_PROCESSED_MSG} tilt-series.'
+
+# Scheduling policies for the alignment steps
+SCHED_FIFO = 0
+SCHED_SJF = 1
+SCHED_ACQ_TIME = 2
+SCHED_POLICIES = ['FIFO', 'Shortest job first', 'Acquisition time']
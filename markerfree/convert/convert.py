@@ -25,8 +25,16 @@
 # *
 # **************************************************************************
 
+import os
+from typing import List, Optional, Tuple
+
+import mrcfile
 import numpy as np
 
+MRC_HEADER_SIZE = 1024
+# Bytes per pixel of the MRC modes that can be read by Markerfree
+MRC_MODE_BYTES = {0: 1, 1: 2, 2: 4, 6: 2, 12: 2}
+
 def readXfFile(xfFile) -> np.ndarray:
     """ This method takes an IMOD-based transformation matrix file (.xf) path and
     returns a 3D matrix containing the transformation matrices for
@@ -48,3 +56,47 @@ def readXfFile(xfFile) -> np.ndarray:
         frameMatrix[2, 2, row] = 1.0
 
     return frameMatrix
+
+
+def checkMrcStack(fileName: str,
+                  nImages: int,
+                  dims: Optional[Tuple[int, int]] = None,
+                  maxIndex: Optional[int] = None) -> Tuple[List[str], List[str]]:
+    """ This method checks an MRC stack reading only its header (the pixel data is not
+    loaded). The stack must contain at least the number of images expected (the tilt-series
+    may use only a subset of it), the highest image index, if provided, must be in the stack
+    range and the image dimensions, if provided, must match the given (x, y) ones.
+    It returns two lists with the problems found, both empty if the stack is fine:
+    the ones that cannot fix themselves (MRC mode, image dimensions) and the ones that may
+    be caused by a stack still being written (missing file, unreadable header, truncated
+    file, number of images). """
+
+    if not fileName or not os.path.isfile(fileName):
+        return [], [f'file {fileName} not found']
+
+    try:
+        with mrcfile.open(fileName, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            nx, ny, nz = int(header.nx), int(header.ny), int(header.nz)
+            mode = int(header.mode)
+            extHeaderSize = int(header.nsymbt)
+    except Exception as e:
+        return [], [f'unable to read the MRC header of {fileName}: {e}']
+
+    errors = []
+    growingErrors = []
+    if mode not in MRC_MODE_BYTES:
+        errors.append(f'unsupported MRC mode {mode}')
+    else:
+        expectedSize = MRC_HEADER_SIZE + extHeaderSize + nx * ny * nz * MRC_MODE_BYTES[mode]
+        fileSize = os.path.getsize(fileName)
+        if fileSize < expectedSize:
+            growingErrors.append(f'truncated file: {fileSize} bytes found, {expectedSize} expected')
+    if nz < nImages:
+        growingErrors.append(f'the stack contains {nz} images, at least {nImages} expected')
+    if maxIndex and maxIndex > nz:
+        growingErrors.append(f'image index {maxIndex} out of the stack range ({nz} images)')
+    if dims and (nx, ny) != tuple(dims):
+        errors.append(f'image dimensions {nx} x {ny} do not match the expected {dims[0]} x {dims[1]}')
+
+    return errors, growingErrors
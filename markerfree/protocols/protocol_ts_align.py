@@ -25,7 +25,9 @@
 # *
 # **************************************************************************
 
+import json
 import logging
+import threading
 import traceback
 import time
 import os
@@ -33,8 +35,9 @@ from os import stat
 from os.path import exists
 
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
 from enum import Enum
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple, Union
 import numpy as np
 
 from pwem.emlib import DT_FLOAT
@@ -42,16 +45,17 @@ from pwem.protocols import EMProtocol
 from pwem.objects.data import Transform
 from pyworkflow.constants import BETA
 import pyworkflow.protocol.params as params
-from pyworkflow.object import Set, Pointer
+from pyworkflow.object import Set, Pointer, String
 from pyworkflow.protocol import STEPS_PARALLEL, LEVEL_ADVANCED, ProtStreamingBase
 from pyworkflow.utils import makePath, cyanStr, redStr
 
 from markerfree import Plugin
 from markerfree.constants import *
-from markerfree.convert import readXfFile
+from markerfree.convert import readXfFile, checkMrcStack
+from markerfree.reconstruction import reconstructTomogram
 
 from tomo.protocols import ProtTomoBase
-from tomo.objects import SetOfTiltSeries, TiltSeries, TiltImage, Pointer
+from tomo.objects import SetOfTiltSeries, TiltSeries, TiltImage, Pointer, SetOfTomograms, Tomogram
 
 logger = logging.getLogger(__name__)
 
@@ -60,12 +64,59 @@ IN_TS_SET = 'inTsSet'
 FAILED_TS = 'FailedTiltSeries'
 
 # Auxiliar variables
+POLLING_TIME = 10  # seconds between checks of the input set
+PREFLIGHT_MAX_THREADS = 8
 EVEN_SUFFIX = '_even'
 ODD_SUFFIX = '_odd'
 IDENTITY_MATRIX = np.eye(3)  # Store in memory instead of multiple creation
 
 class markerfreeOutputs(Enum):
     tiltSeries = SetOfTiltSeries
+    tomograms = SetOfTomograms
+
+
+class TsCostModel:
+    """Estimates the alignment time of a tilt-series from its image size (pixels) and its
+    number of images. The model elapsed = c0 + c1 * pixels + c2 * images + c3 * pixels * images
+    is fitted by least squares to the run times of the tilt-series already aligned by the
+    protocol, so the fixed and per image costs learnt can change the order of the estimates.
+    Until there are enough run times, the cost is the number of pixels of the whole stack.
+    """
+    N_TERMS = 4
+
+    def __init__(self, observations: List[List[float]] = None):
+        self.observations = list(observations or [])  # [pixels, images, elapsed]
+        self._coeffs = None
+        self._fit()
+
+    def addObservation(self, pixels: int, images: int, elapsed: float) -> None:
+        if pixels > 0 and images > 0:
+            self.observations.append([pixels, images, elapsed])
+            self._fit()
+
+    def hasModel(self) -> bool:
+        return self._coeffs is not None
+
+    def estimate(self, pixels: int, images: int) -> float:
+        if self.hasModel():
+            return max(float(np.dot(self._coeffs, self._getTerms(pixels, images))), 0.0)
+        return float(pixels * images)
+
+    @staticmethod
+    def _getTerms(pixels: int, images: int) -> List[float]:
+        return [1.0, float(pixels), float(images), float(pixels) * images]
+
+    def _fit(self) -> None:
+        if len(self.observations) < self.N_TERMS:
+            return
+        terms = np.array([self._getTerms(pixels, images) for pixels, images, _ in self.observations])
+        elapsed = np.array([obs[2] for obs in self.observations])
+        # Normalize the columns, as their magnitudes are very different
+        scale = np.abs(terms).max(axis=0)
+        scale[scale == 0] = 1
+        coeffs = np.linalg.lstsq(terms / scale, elapsed, rcond=None)[0]
+        self._coeffs = coeffs / scale
+
 
 class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase):
     """Protocol to align tilt series using MarkerFree.
@@ -80,6 +131,18 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
         super().__init__(**kwargs)
         self.itemTsIdReadList = []
         self.failedItems = []
+        self.failedReasons = {}
+        self.tsSizes = {}  # {tsId: (pixels, images)}
+        self.pendingTs = {}  # {tsId: ((pixels, images), acquisition time)} waiting to be aligned
+        self.nAlignInFlight = 0
+        self.alignDoneEvent = threading.Event()  # Wakes up the steps generator when a slot gets free
+        self.reconData = {}
+        # The reconstructions run out of the step threads, one at a time (each one uses a process pool)
+        self.reconExecutor = None
+        self.reconFutures = []
+        self.tsIdIndex = {}  # {tsId: objId} of the input set
+        self.costObservations = String()  # Persisted alignment run times (json)
+        self.costModel = TsCostModel()
 
     @classmethod
     def worksInStreaming(cls):
@@ -112,21 +175,76 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
                       label="Projections",
                       help="Number of projections to use in the projection"
                       "matching phase.")
-        '''
+        form.addParam('validateStacks', params.BooleanParam, expertLevel=LEVEL_ADVANCED,
+                      default=True,
+                      label="Check the input stacks before launching?",
+                      help="If set to Yes, the headers of all the input stacks are read before "
+                           "launching the protocol, and it will not be launched if any of them "
+                           "is missing, truncated or does not match its tilt-series metadata. "
+                           "The same check is always carried out on each tilt-series before "
+                           "aligning it, sending the bad ones to the failed tilt-series output. "
+                           "While the input set is open, the tilt-series with missing images or "
+                           "truncated stacks are considered still being acquired and are "
+                           "checked again later.")
+        form.addParam('schedulingPolicy', params.EnumParam, expertLevel=LEVEL_ADVANCED,
+                      choices=SCHED_POLICIES, default=SCHED_FIFO,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Scheduling policy",
+                      help="Order in which the tilt-series waiting in the queue are sent to "
+                           "align:\n"
+                           "\t- FIFO: as they are listed in the input set.\n"
+                           "\t- Shortest job first: smallest estimated cost first. The cost is "
+                           "estimated from the image size and the number of images, with a model "
+                           "fitted to the run times measured for the tilt-series already aligned "
+                           "(the image size times the number of images until there are enough).\n"
+                           "\t- Acquisition time: oldest stacks (file modification time) first.\n"
+                           "The tilt-series are queued and the next one is chosen when an "
+                           "alignment slot gets free. There is one slot per thread, excluding "
+                           "the one used by the steps generator and the one reserved for the "
+                           "output steps. Running small tilt-series first lowers the time to "
+                           "the first results in streaming sessions.")
         form.addParam('doReconstruction', params.BooleanParam,
                       label='Reconstruct tomogram?',
-                      default=True)
+                      default=False,
+                      help="If set to Yes, a tomogram is reconstructed on CPU for each aligned "
+                           "tilt-series by weighted back-projection, using the alignment and the "
+                           "tilt angles obtained and the reconstruction thickness introduced.")
+        form.addParam('reconBinning', params.IntParam,
+                      condition='doReconstruction',
+                      default=4,
+                      validators=[params.GE(1)],
+                      label='Reconstruction binning')
+        form.addParam('reconNumProcs', params.IntParam,
+                      condition='doReconstruction',
+                      default=4,
+                      validators=[params.GE(1)],
+                      label='Reconstruction processes',
+                      help="Number of CPU processes used to reconstruct the tomograms. Each "
+                           "tomogram is split into slabs along the Y axis that are reconstructed "
+                           "in parallel. The tomograms are reconstructed one at a time, out of "
+                           "the protocol threads, so this is the total number of reconstruction "
+                           "processes and they do not delay the alignments.")
+        form.addParam('reconSlabSize', params.IntParam, expertLevel=LEVEL_ADVANCED,
+                      condition='doReconstruction',
+                      default=32,
+                      validators=[params.GE(1)],
+                      label='Slab size (rows)',
+                      help="Number of tomogram rows (binned) reconstructed by each task. The "
+                           "memory used by each process is proportional to it.")
+        '''
         form.addParam('doEvenOdd', params.BooleanParam,
                       condition='doReconstruction=True',
                       label='Reconstruct odd/even tilt-series?',
                       default=False)
         '''
+        form.addParallelSection(threads=3, mpi=0)
         
     def stepsGeneratorStep(self) -> None:
         closeSetStepDeps = []
         inTsSet = self._getInTsSet()
 
         self.readingOutput()
+        self.costModel = TsCostModel(json.loads(self.costObservations.get() or '[]'))
 
         while True:
             with self._lock:
@@ -136,32 +254,76 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
             # ['ts_a', 'ts_b'] != ['ts_b', 'ts_a'], but they are the same with Counter.
             if not inTsSet.isStreamOpen() and Counter(self.itemTsIdReadList) == Counter(listInTsIds):
                 logger.info(cyanStr('Input set closed.\n'))
-                self._insertFunctionStep(self._closeOutputSet,
+                self._insertFunctionStep(self.closeOutputsStep,
                                          prerequisites=closeSetStepDeps,
                                          needsGPU=False)
                 break
 
-            for ts in inTsSet.iterItems():
-                tsId = ts.getTsId()
-                
-                if tsId not in self.itemTsIdReadList and ts.getSize() > 0:  # Avoid processing empty TS (wait for TS imgs to be added)
-                    #TODO: Add exclude views with a convertInputStep
-                    tsAlignId = self._insertFunctionStep(self.runMarkerfreeStep, tsId,
-                                                            prerequisites=[],
-                                                            needsGPU=True)
-                    cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
-                                                        prerequisites=tsAlignId,
-                                                        needsGPU=False)
-                    closeSetStepDeps.append(cOutId)
-                    logger.info(cyanStr(f"Steps created for tsId = {tsId}"))
-                    self.itemTsIdReadList.append(tsId)
-
-            time.sleep(10)
+            newTsList = []
+            snapshots = []
+            newTsIds = [tsId for tsId in listInTsIds
+                        if tsId not in self.itemTsIdReadList and tsId not in self.pendingTs]
+            for tsId, ts in self.getTsListFromTsIds(newTsIds).items():
+                if ts.getSize() > 0:  # Avoid processing empty TS (wait for TS imgs to be added)
+                    snapshots.append(self._getTsSnapshot(ts))
+                    newTsList.append((tsId, self._getTsSize(ts), self._getTsAcqTime(ts)))
+
+            # Bad stacks are sent directly to the failed output, without wasting a GPU slot. The
+            # ones that may still be growing are checked again in the next poll
+            rejected, postponed = self._preflightCheck(snapshots, streamOpen=inTsSet.isStreamOpen())
+            for tsId in postponed:
+                logger.info(cyanStr(f'tsId = {tsId}: stack not complete yet, it will be checked again later'))
+            newTsList = [tsData for tsData in newTsList if tsData[0] not in postponed]
+            for tsId, errors in rejected.items():
+                reason = '; '.join(errors)
+                logger.error(redStr(f'tsId = {tsId} -> pre-flight check failed: {reason}'))
+                self.failedItems.append(tsId)
+                self.failedReasons[tsId] = reason
+                cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
+                                                  prerequisites=[],
+                                                  needsGPU=False)
+                closeSetStepDeps.append(cOutId)
+                self.itemTsIdReadList.append(tsId)
+            for tsId, tsSize, acqTime in newTsList:
+                if tsId not in self.failedItems:
+                    self.pendingTs[tsId] = (tsSize, acqTime)
+
+            # The alignment steps are only inserted when there are free slots, choosing the next
+            # tilt-series among all the queued ones
+            while self.pendingTs and self.nAlignInFlight < self._getNumAlignSlots():
+                tsId, tsSize = self._popNextPendingTs()
+                #TODO: Add exclude views with a convertInputStep
+                self.tsSizes[tsId] = tsSize
+                with self._lock:
+                    self.nAlignInFlight += 1
+                tsAlignId = self._insertFunctionStep(self.runMarkerfreeStep, tsId,
+                                                        prerequisites=[],
+                                                        needsGPU=True)
+                cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
+                                                    prerequisites=tsAlignId,
+                                                    needsGPU=False)
+                closeSetStepDeps.append(cOutId)
+                logger.info(cyanStr(f"Steps created for tsId = {tsId} "
+                                    f"(estimated cost = {self._getCostStr(tsSize)})"))
+                self.itemTsIdReadList.append(tsId)
+
+            # Wait for the next poll, or until an alignment finishes to refill its slot
+            self.alignDoneEvent.wait(timeout=POLLING_TIME)
+            self.alignDoneEvent.clear()
             if inTsSet.isStreamOpen():
                 with self._lock:
                     inTsSet.loadAllProperties()  # refresh status for the streaming
 
     def runMarkerfreeStep(self, tsId: str):
+        try:
+            self._alignTs(tsId)
+        finally:
+            # Free the alignment slot
+            with self._lock:
+                self.nAlignInFlight -= 1
+            self.alignDoneEvent.set()
+
+    def _alignTs(self, tsId: str):
         if tsId not in self.failedItems:
             try:
                 logger.info(cyanStr(f'tsId = {tsId}: aligning...'))
@@ -194,9 +356,17 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
                 # -s1 means that an xf file will be generated
                 args += "-s 1 "
 
+                startTime = time.time()
                 Plugin.runMarkerfree(self, args)
+                elapsed = time.time() - startTime
+                with self._lock:
+                    if tsId in self.tsSizes:
+                        self.costModel.addObservation(*self.tsSizes[tsId], elapsed)
+                        self.costObservations.set(json.dumps(self.costModel.observations))
+                        self._store(self.costObservations)
             except Exception as e:
                 self.failedItems.append(tsId)
+                self.failedReasons[tsId] = f'MarkerFree execution failed: {e}'
                 logger.error(redStr(f'tsId = {tsId} -> MarkerFree execution failed with the exception -> {e}'))
                 logger.error(traceback.format_exc())
 
@@ -204,12 +374,34 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
         if tsId in self.failedItems:
             self.createOutputFailedTs(tsId)
             print('FAILED')
+            return
         try:
             self.createOutputTs(tsId)
             print('SUCESSED')
         except Exception as e:
             logger.error(redStr(f'tsId = {tsId} -> Unable to register the output with exception {e}. Skipping... '))
             logger.error(traceback.format_exc())
+            return
+        if self.doReconstruction.get():
+            self._submitReconstruction(tsId)
+
+    def closeOutputsStep(self):
+        # Wait for the pending reconstructions before closing the outputs
+        with self._lock:
+            reconFutures = list(self.reconFutures)
+        if reconFutures:
+            logger.info(cyanStr(f'Waiting for {len(reconFutures)} reconstruction(s) to finish...'))
+            wait(reconFutures)
+            self.reconExecutor.shutdown()
+        self._closeOutputSet()
+
+    def _submitReconstruction(self, tsId: str) -> None:
+        """ Queues the reconstruction of a tilt-series in the reconstruction executor, so it does
+        not hold a step thread (and thus an alignment slot) while running. """
+        with self._lock:
+            if self.reconExecutor is None:
+                self.reconExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reconstruction')
+            self.reconFutures.append(self.reconExecutor.submit(self.reconstructTs, tsId))
     
     def createOutputTs(self, tsId: str) -> None:
         ts = self.getTsFromTsId(tsId,doLock=True) 
@@ -231,6 +423,7 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
             outTsSet.append(outTs)
             # Tilt-images
             stackIndex = 0
+            projections = []
             for ti in ts.iterItems(orderBy=TiltImage.INDEX_FIELD):
                 outTi = TiltImage()
                 outTi.copyInfo(ti)
@@ -242,7 +435,12 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
                 else:
                     tiltAngle, newTransformArray = self._getTrDataDisabled(ti)
                 self._updateTiltImage(ti, outTi, newTransformArray, tiltAngle)
+                if ti.isEnabled():
+                    projections.append((ti.getIndex(), np.array(outTi.getTransform().getMatrix()), tiltAngle))
                 outTs.append(outTi)
+            # Keep the composed transforms in memory for the reconstruction
+            if self.doReconstruction.get():
+                self.reconData[tsId] = (ts.getFirstItem().getFileName(), ts.getSamplingRate(), projections)
             # Data persistence
             outTs.write()
             outTsSet.update(outTs)
@@ -251,6 +449,72 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
             # Close explicitly the outputs (for streaming)
             self.closeOutputsForStreaming()
 
+    def reconstructTs(self, tsId: str):
+        if tsId in self.failedItems:
+            return
+        try:
+            reconData = self.reconData.pop(tsId, None) or self._getReconDataFromOutput(tsId)
+            if not reconData:
+                logger.error(redStr(f'tsId = {tsId} -> No alignment found to reconstruct. Skipping...'))
+                return
+            stackFn, samplingRate, projections = reconData
+            logger.info(cyanStr(f'tsId = {tsId}: reconstructing...'))
+            binning = self.reconBinning.get()
+            outFn = self._getExtraOutFile(tsId, "rec", MRC_EXT)
+            reconstructTomogram(stackFn, projections, outFn,
+                                thickness=self.geomReconThickness.get(),
+                                binning=binning,
+                                samplingRate=samplingRate,
+                                nProcs=self.reconNumProcs.get(),
+                                slabSize=self.reconSlabSize.get())
+            self.createOutputTomogram(tsId, outFn, samplingRate * binning)
+        except Exception as e:
+            logger.error(redStr(f'tsId = {tsId} -> Unable to reconstruct the tomogram with exception {e}. Skipping... '))
+            logger.error(traceback.format_exc())
+
+    def createOutputTomogram(self, tsId: str, tomoFn: str, samplingRate: float) -> None:
+        with self._lock:
+            outTomoSet = self.getOutputSetOfTomograms(samplingRate)
+            tomo = Tomogram()
+            tomo.setLocation(tomoFn)
+            tomo.setSamplingRate(samplingRate)
+            tomo.setOrigin()
+            tomo.setTsId(tsId)
+            outTomoSet.append(tomo)
+            outTomoSet.write()
+            self._store(outTomoSet)
+            # Close explicitly the outputs (for streaming)
+            outTomoSet.close()
+
+    def getOutputSetOfTomograms(self, samplingRate: float) -> SetOfTomograms:
+        outTomoSet = getattr(self, OUTPUT_TOMOGRAMS_NAME, None)
+        if outTomoSet:
+            outTomoSet.enableAppend()
+        else:
+            inTsPointer = self._getInTsSet(returnPointer=True)
+            outTomoSet = self._createSetOfTomograms()
+            outTomoSet.copyInfo(inTsPointer.get())
+            outTomoSet.setSamplingRate(samplingRate)
+            outTomoSet.setStreamState(Set.STREAM_OPEN)
+            outTomoSet.write()
+
+            self._defineOutputs(**{OUTPUT_TOMOGRAMS_NAME: outTomoSet})
+            self._defineSourceRelation(inTsPointer, outTomoSet)
+
+        return outTomoSet
+
+    def _getReconDataFromOutput(self, tsId: str) -> Union[Tuple[str, float, List], None]:
+        """ Reads the composed transforms from the output tilt-series, used when they are not
+        in memory (e. g. the protocol has been continued). """
+        with self._lock:
+            outTsSet = getattr(self, OUTPUT_TILTSERIES_NAME, None)
+            outTs = outTsSet.getItem(TiltSeries.TS_ID_FIELD, tsId) if outTsSet else None
+            if not outTs:
+                return None
+            projections = [(ti.getIndex(), np.array(ti.getTransform().getMatrix()), ti.getTiltAngle())
+                           for ti in outTs.iterItems(orderBy=TiltImage.INDEX_FIELD) if ti.isEnabled()]
+            return outTs.getFirstItem().getFileName(), outTs.getSamplingRate(), projections
+
     def closeOutputsForStreaming(self):
         # Close explicitly the outputs (for streaming)
         for outputName in self._possibleOutputs.keys():
@@ -321,6 +585,7 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
                 outTsSet = self.getOutputFailedSetOfTiltSeries(inTsSet)
                 newTs = TiltSeries()
                 newTs.copyInfo(ts)
+                newTs.setObjComment(self.failedReasons.get(tsId, ''))
                 outTsSet.append(newTs)
                 newTs.copyItems(ts)
                 newTs.write()
@@ -352,17 +617,58 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
     def getTsFromTsId(self,
                       tsId: str,
                       doLock: bool = True) -> TiltSeries:
-        tsSet = self._getInTsSet()
         if doLock:
             with self._lock:
-                return tsSet.getItem(TiltSeries.TS_ID_FIELD, tsId)
+                return self._getTsByIndex(tsId)
+        else:
+            return self._getTsByIndex(tsId)
+
+    def getTsListFromTsIds(self,
+                           tsIds: List[str],
+                           doLock: bool = True) -> Dict[str, TiltSeries]:
+        """ Fetches the tilt-series corresponding to the given tsIds with a single query by
+        primary key. Returns a dict {tsId: ts} sorted as in the input set. The tsIds not found
+        are not included. """
+        if doLock:
+            with self._lock:
+                return self._getTsListByIndex(tsIds)
         else:
-            return tsSet.getItem(TiltSeries.TS_ID_FIELD, tsId)
+            return self._getTsListByIndex(tsIds)
+
+    def _updateTsIdIndex(self) -> None:
+        """ Adds the tilt-series appended to the input set since the last update to the
+        tsId -> objId index. Only the new rows are read. """
+        lastObjId = max(self.tsIdIndex.values(), default=0)
+        for ts in self._getInTsSet().iterItems(where=f'id > {lastObjId}'):
+            self.tsIdIndex[ts.getTsId()] = ts.getObjId()
+
+    def _getTsByIndex(self, tsId: str) -> TiltSeries:
+        if tsId not in self.tsIdIndex:
+            self._updateTsIdIndex()
+        objId = self.tsIdIndex.get(tsId)
+        # The mapper returns a shared template object, so it is cloned to be used out of the lock
+        return None if objId is None else self._getInTsSet()[objId].clone()
+
+    def _getTsListByIndex(self, tsIds: List[str]) -> Dict[str, TiltSeries]:
+        if any(tsId not in self.tsIdIndex for tsId in tsIds):
+            self._updateTsIdIndex()
+        objIds = [str(self.tsIdIndex[tsId]) for tsId in tsIds if tsId in self.tsIdIndex]
+        if not objIds:
+            return {}
+        # Only the primary key can be used with IN (the attribute names are not mapped to columns)
+        return {ts.getTsId(): ts.clone()
+                for ts in self._getInTsSet().iterItems(where=f'id IN ({",".join(objIds)})')}
     
 
     # --------------------------- INFO functions ------------------------------
     def _validate(self) -> List[str]:
         errorMsg = []
+        if self.validateStacks.get():
+            inTsSet = self._getInTsSet()
+            snapshots = [self._getTsSnapshot(ts) for ts in inTsSet.iterItems() if ts.getSize() > 0]
+            rejected, _ = self._preflightCheck(snapshots, streamOpen=inTsSet.isStreamOpen())
+            for tsId, errors in rejected.items():
+                errorMsg.append(f'tsId = {tsId}: {"; ".join(errors)}')
         return errorMsg
     
     def readingOutput(self) -> None:
@@ -408,6 +714,98 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
 
         return angleList
 
+    @staticmethod
+    def _getTsSnapshot(ts: TiltSeries) -> Dict:
+        """ Collects the tilt-series metadata required by the pre-flight check. It accesses
+        the database, so it has to be called from the thread that owns the set. """
+        tiltImgs = [(ti.getIndex(), ti.isEnabled()) for ti in ts.iterItems()]
+        dims = ts.getDim()
+        acq = ts.getAcquisition()
+        return {'tsId': ts.getTsId(),
+                'fileName': ts.getFirstItem().getFileName(),
+                'dims': tuple(dims[:2]) if dims else None,
+                'nImages': len(tiltImgs),
+                'nEnabled': sum(1 for _, enabled in tiltImgs if enabled),
+                'maxIndex': max((index for index, _ in tiltImgs if index), default=0),
+                'tiltAxisAngle': acq.getTiltAxisAngle() if acq else None}
+
+    @staticmethod
+    def _checkTsSnapshot(snapshot: Dict) -> Tuple[List[str], List[str]]:
+        """ Returns the problems that cannot fix themselves and the ones that may be caused by
+        a tilt-series still being acquired. """
+        errors, growingErrors = checkMrcStack(snapshot['fileName'], snapshot['nImages'],
+                                              dims=snapshot['dims'],
+                                              maxIndex=snapshot['maxIndex'])
+        if not snapshot['tiltAxisAngle']:
+            errors.append('the tilt axis angle is not set (or it is 0)')
+        if snapshot['nEnabled'] == 0:
+            growingErrors.append('there are no enabled tilt-images')
+        return errors, growingErrors
+
+    def _preflightCheck(self,
+                        snapshots: List[Dict],
+                        streamOpen: bool = False) -> Tuple[Dict[str, List[str]], List[str]]:
+        """ Checks the stacks corresponding to the given tilt-series snapshots in parallel
+        (only the MRC headers are read). Returns a dict {tsId: errors} with the tilt-series to
+        reject and a list with the tsIds to check again later: while the input stream is open,
+        the problems that may be caused by a tilt-series still being acquired (number of images,
+        file size) do not reject it."""
+        if not snapshots:
+            return {}, []
+        nThreads = min(PREFLIGHT_MAX_THREADS, len(snapshots))
+        with ThreadPoolExecutor(max_workers=nThreads) as executor:
+            results = executor.map(self._checkTsSnapshot, snapshots)
+        rejected = {}
+        postponed = []
+        for snapshot, (errors, growingErrors) in zip(snapshots, results):
+            if errors or (growingErrors and not streamOpen):
+                rejected[snapshot['tsId']] = errors + growingErrors
+            elif growingErrors:
+                postponed.append(snapshot['tsId'])
+        return rejected, postponed
+
+    def _popNextPendingTs(self) -> Tuple[str, Tuple[int, int]]:
+        """ Takes the next tilt-series to align out of the queue, according to the scheduling
+        policy selected. Returns its tsId and its size (pixels, images). """
+        policy = self.schedulingPolicy.get()
+        if policy == SCHED_SJF:
+            tsId = min(self.pendingTs, key=lambda pendingId: self.costModel.estimate(*self.pendingTs[pendingId][0]))
+        elif policy == SCHED_ACQ_TIME:
+            tsId = min(self.pendingTs, key=lambda pendingId: self.pendingTs[pendingId][1])
+        else:
+            tsId = next(iter(self.pendingTs))  # Insertion order
+        tsSize, _ = self.pendingTs.pop(tsId)
+        return tsId, tsSize
+
+    def _getNumAlignSlots(self) -> int:
+        """ Number of alignment steps that can run at the same time. One thread is used by the
+        steps generator and another one is reserved for the output steps, so they do not wait
+        for the alignments. """
+        return max(self.numberOfThreads.get() - 2, 1)
+
+    @staticmethod
+    def _getTsSize(ts: TiltSeries) -> Tuple[int, int]:
+        """ Size of a tilt-series used to estimate its alignment cost: (pixels per image,
+        number of images). """
+        dims = ts.getDim()
+        if not dims:
+            return 0, ts.getSize()
+        return dims[0] * dims[1], ts.getSize()
+
+    @staticmethod
+    def _getTsAcqTime(ts: TiltSeries) -> float:
+        """ The tilt-series do not store the acquisition time, so the modification time of the
+        stack file is used instead. """
+        try:
+            return os.path.getmtime(ts.getFirstItem().getFileName())
+        except (OSError, AttributeError):
+            return float('inf')
+
+    def _getCostStr(self, tsSize: Tuple[int, int]) -> str:
+        if self.costModel.hasModel():
+            return f'{self.costModel.estimate(*tsSize):.0f} s'
+        return f'{self.costModel.estimate(*tsSize):.0f} px'
+
     def getTltFilePath(self, tsId):
         return self._getExtraOutFile(tsId, suffix="", ext=TLT_EXT)
 
@@ -420,15 +818,11 @@ class ProtMarkerfreeAlignTiltSeries(EMProtocol, ProtTomoBase, ProtStreamingBase)
                                   self._getOutTsFileName(tsId, suffix=suffix, ext=ext))
 
     def _getCurrentTs(self, tsId: str) -> TiltSeries:
-        return self._getInTsSet().getItem(TiltSeries.TS_ID_FIELD, tsId)
+        return self.getTsFromTsId(tsId, doLock=True)
 
     def _getInTsSet(self, returnPointer: bool = False) -> Union[SetOfTiltSeries, Pointer]:
         inTsPointer = getattr(self, IN_TS_SET)
         return inTsPointer if returnPointer else inTsPointer.get()
     
     def _getCurrentItem(self, tsId: str, doLock: bool = True) -> TiltSeries:
-        if doLock:
-            with self._lock:
-                return self._getInTsSet().getItem(TiltSeries.TS_ID_FIELD, tsId)
-        else:
-            return self._getInTsSet().getItem(TiltSeries.TS_ID_FIELD, tsId)
+        return self.getTsFromTsId(tsId, doLock=doLock)
@@ -0,0 +1,176 @@
+# **************************************************************************
+# *
+# * Authors:     Mikel Iceta (miceta@cnb.csic.es)
+# *
+# * National Center of Biotechnology (CNB-CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+CPU weighted back-projection of aligned tilt-series.
+
+The tomogram is split into slabs along Y (the tilt axis once the projections are
+aligned). Each slab only needs the same rows of the aligned projections, so the slabs
+are reconstructed independently in a process pool. The raw projections are read from
+the memory-mapped input stack and the slabs are written into a memory-mapped MRC file,
+so the memory used by each process is bounded by the slab size.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+import mrcfile
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+# (stack index (starting at 1), 3x3 alignment matrix, tilt angle in degrees)
+ProjectionData = Tuple[int, np.ndarray, float]
+
+
+def reconstructTomogram(stackFn: str,
+                        projections: List[ProjectionData],
+                        outFn: str,
+                        thickness: int,
+                        binning: int = 1,
+                        samplingRate: float = 1.0,
+                        nProcs: int = 1,
+                        slabSize: int = 32) -> None:
+    """ Reconstructs a tomogram by weighted back-projection of the given projections.
+    The alignment matrices follow the IMOD xf convention (they map the raw image
+    coordinates, centered, onto the aligned ones), as the ones read with readXfFile.
+
+    :param stackFn: input tilt-series stack.
+    :param projections: list of (stack index, alignment matrix, tilt angle) of the
+    projections to back-project.
+    :param outFn: output tomogram file name.
+    :param thickness: tomogram thickness, in unbinned pixels.
+    :param binning: binning factor applied to the projections and the tomogram.
+    :param samplingRate: sampling rate of the input stack (Å/px).
+    :param nProcs: number of processes used to reconstruct the slabs.
+    :param slabSize: number of tomogram rows (along Y) reconstructed by each task.
+    """
+    with mrcfile.mmap(stackFn, mode='r', permissive=True) as mrc:
+        nx, ny = int(mrc.header.nx), int(mrc.header.ny)
+    nxb, nyb, nzb = nx // binning, ny // binning, max(thickness // binning, 1)
+
+    with mrcfile.new_mmap(outFn, shape=(nzb, nyb, nxb), mrc_mode=2, overwrite=True) as mrc:
+        mrc.voxel_size = samplingRate * binning
+
+    slabs = [(y0, min(y0 + slabSize, nyb)) for y0 in range(0, nyb, slabSize)]
+    tasks = [(stackFn, projections, outFn, (nx, ny), binning, slab) for slab in slabs]
+    # Spawn instead of fork, as the protocol steps run in threads
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max(nProcs, 1), mp_context=context) as executor:
+        stats = list(executor.map(_reconstructSlab, tasks))
+
+    # Header statistics combined from the ones of each slab
+    nVoxels = nxb * nyb * nzb
+    vMean = sum(slabStats[2] for slabStats in stats) / nVoxels
+    vMeanSq = sum(slabStats[3] for slabStats in stats) / nVoxels
+    with mrcfile.mmap(outFn, mode='r+') as mrc:
+        mrc.header.dmin = min(slabStats[0] for slabStats in stats)
+        mrc.header.dmax = max(slabStats[1] for slabStats in stats)
+        mrc.header.dmean = vMean
+        mrc.header.rms = np.sqrt(max(vMeanSq - vMean ** 2, 0))
+
+
+def _reconstructSlab(task) -> Tuple[float, float, float, float]:
+    """ Reconstructs the tomogram rows [y0, y1) and writes them into the output file.
+    Returns the min, max, sum and sum of squares of the slab. """
+    stackFn, projections, outFn, rawDims, binning, (y0, y1) = task
+    nx, ny = rawDims
+    with mrcfile.mmap(outFn, mode='r') as mrc:
+        nzb, _, nxb = mrc.data.shape
+
+    # Tomogram coordinates of the slab, centered
+    xc = np.arange(nxb) - nxb / 2
+    zc = (np.arange(nzb) - nzb / 2)[:, np.newaxis]
+    slab = np.zeros((y1 - y0, nzb, nxb), dtype=np.float32)
+
+    with mrcfile.mmap(stackFn, mode='r', permissive=True) as mrc:
+        stack = mrc.data if mrc.data.ndim == 3 else mrc.data[np.newaxis]
+        for index, matrix, tiltAngle in projections:
+            rows = _getAlignedRows(stack[index - 1], matrix, (nx, ny), binning, y0, y1)
+            rows = _weightRows(rows)
+            angle = np.deg2rad(tiltAngle)
+            u = xc * np.cos(angle) + zc * np.sin(angle) + nxb / 2
+            i0 = np.floor(u).astype(int)
+            w = (u - i0).astype(np.float32)
+            valid = (i0 >= 0) & (i0 < nxb - 1)
+            i0 = np.clip(i0, 0, nxb - 2)
+            slab += np.where(valid, rows[:, i0] * (1 - w) + rows[:, i0 + 1] * w, 0)
+
+    slab *= np.pi / max(len(projections), 1)
+    with mrcfile.mmap(outFn, mode='r+') as mrc:
+        mrc.data[:, y0:y1, :] = slab.transpose(1, 0, 2)
+
+    slab64 = slab.astype(np.float64)
+    return float(slab.min()), float(slab.max()), float(slab64.sum()), float((slab64 ** 2).sum())
+
+
+def _getAlignedRows(image: np.ndarray,
+                    matrix: np.ndarray,
+                    rawDims: Tuple[int, int],
+                    binning: int,
+                    y0: int,
+                    y1: int) -> np.ndarray:
+    """ Applies the alignment to a raw projection and returns the binned rows [y0, y1).
+    The rows are interpolated in chunks of columns as wide as the slab is high, reading
+    only the bounding box of the raw region required by each chunk. This way the memory
+    and the data read are proportional to the slab size for any in-plane rotation. """
+    nx, ny = rawDims
+    nxb = nx // binning
+    # Aligned coordinates of the unbinned pixels covered by the binned rows, centered
+    xa = np.arange(nxb * binning) - nx / 2
+    ya = np.arange(y0 * binning, y1 * binning) - ny / 2
+    xGrid, yGrid = np.meshgrid(xa, ya)
+    # Raw coordinates: inverse of aligned = A * raw + shifts
+    invA = np.linalg.inv(matrix[:2, :2])
+    xGrid -= matrix[0, 2]
+    yGrid -= matrix[1, 2]
+    xRaw = invA[0, 0] * xGrid + invA[0, 1] * yGrid + nx / 2
+    yRaw = invA[1, 0] * xGrid + invA[1, 1] * yGrid + ny / 2
+
+    aligned = np.empty(xRaw.shape, dtype=np.float32)
+    chunkSize = (y1 - y0) * binning
+    for c0 in range(0, xRaw.shape[1], chunkSize):
+        c1 = c0 + chunkSize
+        xChunk, yChunk = xRaw[:, c0:c1], yRaw[:, c0:c1]
+        yMin = int(np.clip(np.floor(yChunk.min()), 0, ny - 1))
+        yMax = int(np.clip(np.ceil(yChunk.max()) + 1, yMin + 1, ny))
+        xMin = int(np.clip(np.floor(xChunk.min()), 0, nx - 1))
+        xMax = int(np.clip(np.ceil(xChunk.max()) + 1, xMin + 1, nx))
+        region = np.asarray(image[yMin:yMax, xMin:xMax], dtype=np.float32)
+        # Pixels out of the raw image are filled with the region mean to avoid edge artifacts
+        aligned[:, c0:c1] = map_coordinates(region, [yChunk - yMin, xChunk - xMin], order=1,
+                                            mode='constant', cval=float(region.mean()))
+    return aligned.reshape(y1 - y0, binning, nxb, binning).mean(axis=(1, 3))
+
+
+def _weightRows(rows: np.ndarray) -> np.ndarray:
+    """ Applies the ramp filter (with a Hamming window) along X. """
+    nxb = rows.shape[1]
+    padSize = 2 ** int(np.ceil(np.log2(2 * nxb)))
+    freqs = np.fft.rfftfreq(padSize)
+    weights = 2 * freqs * (0.54 + 0.46 * np.cos(2 * np.pi * freqs))
+    rows = rows - rows.mean(axis=1, keepdims=True)
+    filtered = np.fft.irfft(np.fft.rfft(rows, n=padSize, axis=1) * weights, n=padSize, axis=1)
+    return filtered[:, :nxb].astype(np.float32)
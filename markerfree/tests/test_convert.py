@@ -0,0 +1,86 @@
+# **************************************************************************
+# *
+# * Authors:     Mikel Iceta (miceta@cnb.csic.es)
+# *
+# * National Center of Biotechnology (CNB-CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mrcfile
+import numpy as np
+
+from markerfree.convert import checkMrcStack
+
+
+class TestCheckMrcStack(unittest.TestCase):
+    """ Pre-flight check of the MRC stacks reading only their header. """
+    nImages, ny, nx = 5, 32, 40
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.stackFn = os.path.join(self.tmpDir, 'ts.mrc')
+        mrcfile.new(self.stackFn, np.zeros((self.nImages, self.ny, self.nx), dtype=np.float32))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testValid(self):
+        self.assertEqual(checkMrcStack(self.stackFn, self.nImages, dims=(self.nx, self.ny)), ([], []))
+
+    def testTruncated(self):
+        os.truncate(self.stackFn, os.path.getsize(self.stackFn) - self.nx * self.ny * 4)
+        errors, growingErrors = checkMrcStack(self.stackFn, self.nImages, dims=(self.nx, self.ny))
+        self.assertEqual(errors, [])
+        self.assertEqual(len(growingErrors), 1)
+        self.assertIn('truncated', growingErrors[0])
+
+    def testWrongNumberOfImages(self):
+        errors, growingErrors = checkMrcStack(self.stackFn, self.nImages + 2, dims=(self.nx, self.ny))
+        self.assertEqual(errors, [])
+        self.assertEqual(len(growingErrors), 1)
+        self.assertIn('images', growingErrors[0])
+
+    def testSubsetOfStack(self):
+        result = checkMrcStack(self.stackFn, self.nImages - 2, dims=(self.nx, self.ny), maxIndex=self.nImages)
+        self.assertEqual(result, ([], []))
+
+    def testIndexOutOfRange(self):
+        errors, growingErrors = checkMrcStack(self.stackFn, self.nImages, maxIndex=self.nImages + 1)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(growingErrors), 1)
+        self.assertIn('out of the stack range', growingErrors[0])
+
+    def testWrongDims(self):
+        errors, growingErrors = checkMrcStack(self.stackFn, self.nImages, dims=(self.ny, self.nx))
+        self.assertEqual(len(errors), 1)
+        self.assertIn('dimensions', errors[0])
+        self.assertEqual(growingErrors, [])
+
+    def testMissingFile(self):
+        errors, growingErrors = checkMrcStack(os.path.join(self.tmpDir, 'missing.mrc'), self.nImages)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(growingErrors), 1)
+        self.assertIn('not found', growingErrors[0])
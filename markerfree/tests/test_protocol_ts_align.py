@@ -0,0 +1,169 @@
+# **************************************************************************
+# *
+# * Authors:     Mikel Iceta (miceta@cnb.csic.es)
+# *
+# * National Center of Biotechnology (CNB-CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import shutil
+import tempfile
+import unittest
+
+from tomo.objects import SetOfTiltSeries, TiltSeries, TiltImage
+
+from markerfree.constants import SCHED_FIFO, SCHED_SJF, SCHED_ACQ_TIME
+from markerfree.protocols.protocol_ts_align import ProtMarkerfreeAlignTiltSeries, TsCostModel
+
+
+def _appendTs(tsSet: SetOfTiltSeries, tsId: str, nImages: int = 3) -> None:
+    ts = TiltSeries(tsId=tsId)
+    tsSet.append(ts)
+    for index in range(1, nImages + 1):
+        ti = TiltImage(tsId=tsId)
+        ti.setLocation(index, f'{tsId}.mrc')
+        ts.append(ti)
+    tsSet.update(ts)
+    tsSet.write()
+
+
+class TestTsIdIndex(unittest.TestCase):
+    """ tsId -> objId index of the input set, against a real sqlite set. """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.tsSet = SetOfTiltSeries.create(self.tmpDir)
+        for tsId in ['ts_a', 'ts_b', 'ts_c']:
+            _appendTs(self.tsSet, tsId)
+        self.prot = ProtMarkerfreeAlignTiltSeries()
+        self.prot.inTsSet.set(self.tsSet)
+
+    def tearDown(self):
+        self.tsSet.close()
+        shutil.rmtree(self.tmpDir)
+
+    def testBulkFetchNotIndexed(self):
+        tsDict = self.prot.getTsListFromTsIds(['ts_c', 'ts_a'])
+        self.assertEqual(list(tsDict), ['ts_a', 'ts_c'])  # Input set order
+        self.assertEqual({tsId: ts.getTsId() for tsId, ts in tsDict.items()},
+                         {'ts_a': 'ts_a', 'ts_c': 'ts_c'})
+        self.assertEqual(set(self.prot.tsIdIndex), {'ts_a', 'ts_b', 'ts_c'})
+
+    def testIndexGrowsWithStream(self):
+        self.prot.getTsListFromTsIds(['ts_a'])
+        _appendTs(self.tsSet, 'ts_d')
+        tsDict = self.prot.getTsListFromTsIds(['ts_b', 'ts_d', 'missing'])
+        self.assertEqual(list(tsDict), ['ts_b', 'ts_d'])
+        self.assertEqual(tsDict['ts_d'].getSize(), 3)
+        self.assertIn('ts_d', self.prot.tsIdIndex)
+
+    def testSingleFetch(self):
+        self.assertEqual(self.prot.getTsFromTsId('ts_b').getTsId(), 'ts_b')
+        self.assertIsNone(self.prot.getTsFromTsId('missing'))
+
+    def testFetchedTsNotShared(self):
+        tsA = self.prot.getTsFromTsId('ts_a')
+        tsB = self.prot.getTsFromTsId('ts_b')
+        self.assertIsNot(tsA, tsB)
+        self.assertEqual(tsA.getTsId(), 'ts_a')
+        self.assertEqual(self.prot._getCurrentTs('ts_c').getTsId(), 'ts_c')
+        self.assertEqual(tsB.getTsId(), 'ts_b')
+
+
+class TestTsCostModel(unittest.TestCase):
+    """ Alignment cost model learnt from the run times. """
+
+    @staticmethod
+    def _runTime(pixels, images):
+        return 60 + 2 * images + 1e-7 * pixels * images
+
+    def _getTrainedModel(self):
+        model = TsCostModel()
+        for pixels, images in [(4e6, 40), (16e6, 20), (4e6, 60), (16e6, 41), (8e6, 30)]:
+            model.addObservation(pixels, images, self._runTime(pixels, images))
+        return model
+
+    def testFallback(self):
+        model = TsCostModel()
+        for pixels, images in [(4e6, 40), (16e6, 20), (8e6, 30)]:
+            model.addObservation(pixels, images, self._runTime(pixels, images))
+        self.assertFalse(model.hasModel())
+        self.assertEqual(model.estimate(16e6, 20), 16e6 * 20)
+
+    def testFit(self):
+        model = self._getTrainedModel()
+        self.assertTrue(model.hasModel())
+        self.assertAlmostEqual(model.estimate(8e6, 50), self._runTime(8e6, 50), places=3)
+        # The fixed and per image costs learnt change the order given by the stack size
+        self.assertGreater(16e6 * 20, 1e6 * 90)
+        self.assertLess(model.estimate(16e6, 20), model.estimate(1e6, 90))
+
+    def testRestoredFromObservations(self):
+        model = self._getTrainedModel()
+        restored = TsCostModel(model.observations)
+        self.assertAlmostEqual(restored.estimate(8e6, 50), model.estimate(8e6, 50))
+
+    def testNegativeClamp(self):
+        model = TsCostModel()
+        for pixels, images in [(4e6, 40), (16e6, 20), (4e6, 60), (16e6, 50), (8e6, 30)]:
+            model.addObservation(pixels, images, 10 * images - 150)
+        self.assertEqual(model.estimate(4e6, 1), 0.0)
+
+
+class TestSchedulingPolicy(unittest.TestCase):
+    """ Choice of the next queued tilt-series to align. """
+
+    def setUp(self):
+        self.prot = ProtMarkerfreeAlignTiltSeries()
+        # {tsId: ((pixels, images), acquisition time)}, in arrival order
+        self.prot.pendingTs = {'ts_big': ((16e6, 60), 300.0),
+                               'ts_small': ((4e6, 20), 200.0),
+                               'ts_old': ((8e6, 40), 100.0)}
+
+    def _popAll(self, policy):
+        self.prot.schedulingPolicy.set(policy)
+        tsIds = []
+        while self.prot.pendingTs:
+            tsIds.append(self.prot._popNextPendingTs()[0])
+        return tsIds
+
+    def testFifo(self):
+        self.assertEqual(self._popAll(SCHED_FIFO), ['ts_big', 'ts_small', 'ts_old'])
+
+    def testShortestJobFirst(self):
+        self.assertEqual(self._popAll(SCHED_SJF), ['ts_small', 'ts_old', 'ts_big'])
+
+    def testShortestJobFirstLearnt(self):
+        # Cost dominated by the number of images: the opposite order than the stack size
+        for pixels, images in [(4e6, 40), (16e6, 20), (4e6, 60), (16e6, 41), (8e6, 30)]:
+            self.prot.costModel.addObservation(pixels, images, 60 + 2 * images)
+        self.prot.pendingTs = {'ts_fewLarge': ((16e6, 20), 0.0),
+                               'ts_manySmall': ((1e6, 90), 0.0)}
+        self.assertEqual(self._popAll(SCHED_SJF), ['ts_fewLarge', 'ts_manySmall'])
+
+    def testAcquisitionTime(self):
+        self.assertEqual(self._popAll(SCHED_ACQ_TIME), ['ts_old', 'ts_small', 'ts_big'])
+
+    def testSlots(self):
+        self.prot.numberOfThreads.set(3)
+        self.assertEqual(self.prot._getNumAlignSlots(), 1)
+        self.prot.numberOfThreads.set(6)
+        self.assertEqual(self.prot._getNumAlignSlots(), 4)
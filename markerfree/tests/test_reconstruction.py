@@ -0,0 +1,94 @@
+# **************************************************************************
+# *
+# * Authors:     Mikel Iceta (miceta@cnb.csic.es)
+# *
+# * National Center of Biotechnology (CNB-CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mrcfile
+import numpy as np
+
+from markerfree.reconstruction import reconstructTomogram
+
+
+class TestReconstruction(unittest.TestCase):
+    """ Weighted back-projection of a synthetic point phantom with identity alignments. """
+    nx, ny = 64, 48
+    tiltAngles = np.arange(-60, 61, 3)
+    point = (10, 8, 5)  # x, y, z from the center, in pixels
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        cls.stackFn = os.path.join(cls.tmpDir, 'ts.mrc')
+        px, py, pz = cls.point
+        stack = np.zeros((len(cls.tiltAngles), cls.ny, cls.nx), dtype=np.float32)
+        for i, tiltAngle in enumerate(cls.tiltAngles):
+            angle = np.deg2rad(tiltAngle)
+            u = px * np.cos(angle) + pz * np.sin(angle)
+            stack[i, py + cls.ny // 2, int(round(u + cls.nx / 2))] = 1
+        mrcfile.new(cls.stackFn, stack, overwrite=True)
+        cls.projections = [(i + 1, np.eye(3), float(tiltAngle)) for i, tiltAngle in enumerate(cls.tiltAngles)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    def _reconstruct(self, binning):
+        outFn = os.path.join(self.tmpDir, f'rec_bin{binning}.mrc')
+        reconstructTomogram(self.stackFn, self.projections, outFn,
+                            thickness=32,
+                            binning=binning,
+                            samplingRate=1.5,
+                            nProcs=2,
+                            slabSize=5)
+        return outFn
+
+    def _checkTomogram(self, outFn, binning):
+        px, py, pz = self.point
+        nxb, nyb, nzb = self.nx // binning, self.ny // binning, 32 // binning
+        with mrcfile.open(outFn, permissive=True) as mrc:
+            data = mrc.data.astype(np.float64)
+            header = mrc.header
+            self.assertEqual(data.shape, (nzb, nyb, nxb))
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 1.5 * binning, places=4)
+            # Object position
+            z, y, x = np.unravel_index(np.argmax(data), data.shape)
+            self.assertLessEqual(abs(x - (nxb / 2 + px / binning)), 1)
+            self.assertLessEqual(abs(y - (nyb / 2 + py / binning)), 1)
+            self.assertLessEqual(abs(z - (nzb / 2 + pz / binning)), 1)
+            # Header statistics merged from the slabs
+            self.assertAlmostEqual(float(header.dmin), data.min(), places=5)
+            self.assertAlmostEqual(float(header.dmax), data.max(), places=5)
+            self.assertAlmostEqual(float(header.dmean), data.mean(), places=5)
+            self.assertAlmostEqual(float(header.rms), data.std(), places=5)
+
+    def testReconstruction(self):
+        self._checkTomogram(self._reconstruct(binning=1), binning=1)
+
+    def testReconstructionBinned(self):
+        self._checkTomogram(self._reconstruct(binning=2), binning=2)